@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import argparse
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from synthetic import add_matrix_arguments, generate_matrix
+
+
+def profile(function, repeat=1):
+    # Best wall time, CPU time of that run and peak traced allocation (MB)
+    # over repeat calls of function
+    best = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = function()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if best is None or wall < best[0]:
+            best = (wall, cpu, peak / 1024 / 1024)
+    return best, result
+
+
+def run_benchmarks(matrix, output_dir, repeat=1, reader="python"):
+    from q2_ps_qc.actions.generate_corr_matrix import (
+        generate_corr_tsv, generate_metadata, group_replicates
+    )
+    from q2_ps_qc.correlation import correlation_table
+    from q2_ps_qc.score_matrix import load_score_matrix
+
+    timings = []
+
+    timing, score_matrix = profile(
+        lambda: load_score_matrix(matrix, reader=reader), repeat
+    )
+    timings.append(("load_score_matrix", timing))
+
+    replicates = list(score_matrix.samples)
+    groups = {
+        group: positions
+        for group, positions in group_replicates(replicates).items()
+        if len(positions) > 1
+    }
+    timing, corr_table = profile(
+        lambda: correlation_table(score_matrix.values, replicates, groups),
+        repeat
+    )
+    timings.append(("correlation_table", timing))
+
+    # Split samples in two like a good/bad classification would
+    half = len(replicates) // 2
+    corr_files = {
+        os.path.join(output_dir, "bad_corr.tsv"): replicates[:half],
+        os.path.join(output_dir, "good_corr.tsv"): replicates[half:]
+    }
+    timing, _ = profile(
+        lambda: generate_corr_tsv(
+            [(score_matrix.peptides, score_matrix.values)],
+            replicates,
+            corr_files
+        ),
+        repeat
+    )
+    timings.append(("generate_corr_tsv", timing))
+
+    timing, _ = profile(lambda: generate_metadata(list(replicates)), repeat)
+    timings.append(("generate_metadata", timing))
+
+    # The full pipeline, including both scatter plot visualizations
+    from qiime2.plugins import ps_qc
+    timing, _ = profile(
+        lambda: ps_qc.pipelines.generate_corr_matrix(
+            data=matrix, reader=reader
+        ),
+        repeat
+    )
+    timings.append(("generate_corr_matrix", timing))
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time and memory-profile q2-ps-qc on a synthetic score"
+            " matrix."
+    )
+    add_matrix_arguments(parser)
+    parser.add_argument("--matrix",
+                        help="Benchmark this TSV instead of generating one.")
+    parser.add_argument("--reader", default="python",
+                        choices=["python", "pandas", "pyarrow"],
+                        help="Score matrix reader to benchmark.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per stage; the fastest is reported.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        matrix = args.matrix
+        if matrix is None:
+            matrix = os.path.join(output_dir, "synthetic.tsv")
+            generate_matrix(
+                matrix, args.peptides, args.groups, args.replicates,
+                args.singletons, args.kind, args.noise, args.nan_fraction,
+                args.seed
+            )
+
+        timings = run_benchmarks(
+            matrix, output_dir, args.repeat, args.reader
+        )
+
+    print("%-22s %10s %10s %12s" % ("stage", "wall (s)", "cpu (s)", "peak (MB)"))
+    for stage, (wall, cpu, peak) in timings:
+        print("%-22s %10.3f %10.3f %12.1f" % (stage, wall, cpu, peak))
+    print("max RSS: %.1f MB" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Modules that are slow to import. Registering FeatureTable inputs needs
+# q2_types.feature_table, which loads biom and scipy, so those are expected;
+# q2-ps-qc itself does not import altair
+HEAVY_MODULES = ["altair", "biom", "scipy"]
+
+# Run in a fresh interpreter: import the module and report how long it took
+# and which heavy modules it loaded
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({
+    "seconds": seconds,
+    "loaded": [name for name in %r if name in sys.modules]
+}))
+"""
+
+
+def time_import(module, repeat=5):
+    # Import times (seconds) of module over repeat fresh interpreters, and
+    # the heavy modules loaded by the last of them
+    seconds = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE % (module, HEAVY_MODULES)],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+        probe = json.loads(result.stdout.splitlines()[-1])
+        seconds.append(probe["seconds"])
+    return seconds, probe["loaded"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time how long importing the q2-ps-qc plugin takes, as"
+            " happens on every qiime CLI invocation."
+    )
+    parser.add_argument("--module", default="q2_ps_qc.plugin_setup",
+                        help="Module to import.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of fresh interpreters to time.")
+    args = parser.parse_args()
+
+    seconds, loaded = time_import(args.module, args.repeat)
+    print("import %s" % args.module)
+    print("  median: %.3f s" % statistics.median(seconds))
+    print("  min:    %.3f s" % min(seconds))
+    print("  heavy modules loaded: %s" % (", ".join(loaded) or "none"))
+    print("Run python -X importtime -c 'import %s' for a per-module"
+          " breakdown." % args.module)
+
+
+if __name__ == "__main__":
+    main()
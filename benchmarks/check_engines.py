@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from q2_ps_qc.correlation import (
+    correlation_table, group_log_constants, log_normalize,
+    sparse_correlation_table, sparse_group_log_constants,
+    streaming_correlation_table
+)
+
+LN_CONSTANT = 11
+
+
+def expected_correlations(values, groups, constants=None):
+    # Pearson r of every within-group pair from pandas' corr(), which leaves
+    # out the rows where either score is NaN
+    r = []
+    for index, positions in enumerate(groups.values()):
+        block = values[:, positions]
+        if constants is not None:
+            block = log_normalize(block, constants[index])
+        block = np.where(np.isfinite(block), block, np.nan)
+        corr = pd.DataFrame(block).corr().values
+        r.extend(corr[np.triu_indices(len(positions), k=1)])
+    return np.array(r)
+
+
+def engine_correlations(values, samples, groups, log_normalization,
+                        chunk_size):
+    # r of every within-group pair from each correlation engine
+    group_positions = list(groups.values())
+    constants = None
+    sparse_constants = None
+    matrix = scipy.sparse.csc_matrix(values)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    if log_normalization:
+        constants = group_log_constants(values, group_positions, LN_CONSTANT)
+        sparse_constants = sparse_group_log_constants(
+            matrix, group_positions, LN_CONSTANT
+        )
+
+    def read_chunks():
+        for start in range(0, len(values), chunk_size):
+            yield None, values[start:start + chunk_size].copy()
+
+    return {
+        "dense": correlation_table(
+            values, samples, groups, constants=constants
+        )["r"].values,
+        "parallel": correlation_table(
+            values, samples, groups, n_jobs=2, constants=constants
+        )["r"].values,
+        "sparse": sparse_correlation_table(
+            matrix, samples, groups, sparse_constants
+        )["r"].values,
+        "streaming": streaming_correlation_table(
+            read_chunks, samples, groups,
+            LN_CONSTANT if log_normalization else None
+        )["r"].values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that every correlation engine agrees with pandas'"
+            " corr() on scores that include values below -%d, which log"
+            " normalization cannot take the logarithm of." % LN_CONSTANT
+    )
+    parser.add_argument("--peptides", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--replicates", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n_samples = args.groups * args.replicates
+    signal = rng.normal(0, 4, size=(args.peptides, args.groups))
+    values = np.repeat(signal, args.replicates, axis=1) \
+        + rng.normal(0, 2, size=(args.peptides, n_samples))
+    values[rng.random(values.shape) < 0.3] = 0
+    values[rng.random(values.shape) < 0.02] = -LN_CONSTANT - 5
+
+    samples = ["S%d_%d" % (group, replicate)
+               for group in range(args.groups)
+               for replicate in range(args.replicates)]
+    groups = {
+        "S%d" % group: list(range(
+            group * args.replicates, (group + 1) * args.replicates
+        ))
+        for group in range(args.groups)
+    }
+
+    failed = False
+    for log_normalization in (False, True):
+        constants = None
+        if log_normalization:
+            constants = group_log_constants(
+                values, list(groups.values()), LN_CONSTANT
+            )
+        expected = expected_correlations(values, groups, constants)
+        for engine, r in engine_correlations(
+                values, samples, groups, log_normalization,
+                args.chunk_size).items():
+            agrees = np.allclose(r, expected, equal_nan=True)
+            failed |= not agrees
+            print("log_normalization=%-5s %-9s %s" % (
+                log_normalization, engine, "ok" if agrees else "MISMATCH"
+            ))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
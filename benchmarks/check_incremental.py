@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+import numpy as np
+
+from q2_ps_qc.actions.generate_corr_matrix import (
+    group_fingerprints, merge_correlations, pair_status, paired_groups,
+    replicate_correlations, reusable_groups
+)
+from q2_ps_qc.correlation import correlation_table
+
+CORRELATION_THRESHOLD = 0.8
+
+
+def correlate(values, replicates, samples, previous_table=None):
+    # The pair table, pair statuses and replicate r of a run over the groups
+    # of samples, reusing previous_table the way generate-corr-matrix does
+    groups = paired_groups(replicates, samples)
+    fingerprints = group_fingerprints(values, replicates, groups, None,
+                                      "pearson")
+    reused_groups = set()
+    if previous_table is not None:
+        reused_groups = reusable_groups(
+            previous_table, replicates, groups, fingerprints
+        )
+
+    corr_table = correlation_table(values, replicates, {
+        group: positions for group, positions in groups.items()
+        if group not in reused_groups
+    })
+    corr_table["fingerprint_a"] = [
+        fingerprints[(pair.group, pair.sample_a)]
+        for pair in corr_table.itertuples(index=False)
+    ]
+    corr_table["fingerprint_b"] = [
+        fingerprints[(pair.group, pair.sample_b)]
+        for pair in corr_table.itertuples(index=False)
+    ]
+    if previous_table is not None:
+        corr_table = merge_correlations(
+            previous_table, corr_table, groups, reused_groups
+        )
+    corr_table["status"] = pair_status(
+        corr_table, groups, CORRELATION_THRESHOLD
+    )
+
+    current = corr_table[corr_table["group"].isin(groups)]
+    statuses = {
+        (pair.group, pair.sample_a, pair.sample_b): pair.status
+        for pair in current.itertuples(index=False)
+    }
+    return corr_table, statuses, replicate_correlations(corr_table, groups)
+
+
+def agrees(first_run, second_run):
+    # Whether a second run reusing the first run's table gives the same
+    # statuses and replicate r as a fresh run of the second matrix
+    previous_table, _, _ = correlate(*first_run)
+    _, statuses, replicate_r = correlate(*second_run, previous_table)
+    _, fresh_statuses, fresh_replicate_r = correlate(*second_run)
+    return statuses == fresh_statuses \
+        and replicate_r.keys() == fresh_replicate_r.keys() \
+        and np.allclose(
+            [replicate_r[rep] for rep in fresh_replicate_r],
+            list(fresh_replicate_r.values())
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that an incremental run classifies replicates the"
+            " same as a fresh run of the same matrix when groups change"
+            " between runs."
+    )
+    parser.add_argument("--peptides", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    signal = rng.normal(0, 4, size=(args.peptides, 1))
+
+    def replicate():
+        return signal + rng.normal(0, 0.2, size=signal.shape)
+
+    # A later plate adds X_1 and rescores X_3, which first disagreed with X_2
+    triplicate = ["X_1\tX_2\tX_3".split("\t")]
+    plate_growth = agrees(
+        (np.hstack([replicate(), -replicate()]), ["X_2", "X_3"], triplicate),
+        (np.hstack([replicate(), replicate(), replicate()]),
+         ["X_1", "X_2", "X_3"], triplicate)
+    )
+
+    # A, B and C are all kept, but the samples file stops pairing A with C,
+    # which disagree
+    values = np.hstack([replicate(), replicate(), -replicate()])
+    regrouped = agrees(
+        (values, ["A", "B", "C"], [["A", "B"], ["A", "C"]]),
+        (values, ["A", "B", "C"], [["A", "B"]])
+    )
+
+    failed = False
+    for check, ok in (("plate growth", plate_growth), ("regrouped", regrouped)):
+        failed |= not ok
+        print("%-12s %s" % (check, "ok" if ok else "MISMATCH"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import argparse
+import numpy as np
+import pandas as pd
+
+REPLICATE_SUFFIXES = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def sample_names(groups, replicates, singletons=0):
+    # PepSIRF-style sample names; replicates of a group share everything up to
+    # the last "_"
+    names = [
+        "S%d_pA_%s" % (group, REPLICATE_SUFFIXES[replicate])
+        for group in range(groups)
+        for replicate in range(replicates)
+    ]
+    names.extend("Ctrl%d_pA" % singleton for singleton in range(singletons))
+    return names
+
+
+def generate_values(peptides, groups, replicates, singletons=0,
+                    kind="zscore", noise=0.5, nan_fraction=0.0, seed=0):
+    # Scores for every sample. Replicates of a group share a latent signal,
+    # so their correlation is set by noise. "zscore" gives heavy-tailed
+    # scores; "normed" gives mostly-zero normalized counts
+    rng = np.random.default_rng(seed)
+    columns = []
+
+    for _ in range(groups):
+        if kind == "zscore":
+            signal = rng.standard_t(3, size=peptides)
+        else:
+            signal = rng.exponential(1.0, size=peptides) \
+                * (rng.random(peptides) < 0.05) * 50
+        for _ in range(replicates):
+            if kind == "zscore":
+                columns.append(signal + rng.normal(0, noise, size=peptides))
+            else:
+                columns.append(rng.poisson(signal * (1 + noise)).astype(float))
+
+    for _ in range(singletons):
+        if kind == "zscore":
+            columns.append(rng.standard_t(3, size=peptides))
+        else:
+            columns.append(rng.poisson(rng.exponential(1.0, size=peptides)
+                                       * (rng.random(peptides) < 0.05) * 50)
+                           .astype(float))
+
+    values = np.column_stack(columns) if columns \
+        else np.empty((peptides, 0))
+    if nan_fraction:
+        values[rng.random(values.shape) < nan_fraction] = np.nan
+    return values
+
+
+def write_matrix(path, values, samples):
+    # Write a PepSIRF score matrix TSV
+    matrix = pd.DataFrame(
+        values,
+        index=pd.Index(
+            ["pep_%d" % index for index in range(len(values))],
+            name="Sequence name"
+        ),
+        columns=samples
+    )
+    matrix.to_csv(path, sep="\t", float_format="%.4f", na_rep="nan")
+
+
+def generate_matrix(path, peptides, groups, replicates, singletons=0,
+                    kind="zscore", noise=0.5, nan_fraction=0.0, seed=0):
+    samples = sample_names(groups, replicates, singletons)
+    values = generate_values(
+        peptides, groups, replicates, singletons, kind, noise,
+        nan_fraction, seed
+    )
+    write_matrix(path, values, samples)
+    return samples
+
+
+def add_matrix_arguments(parser):
+    parser.add_argument("--peptides", type=int, default=20000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--replicates", type=int, default=2,
+                        help="Replicates per group.")
+    parser.add_argument("--singletons", type=int, default=0,
+                        help="Samples that belong to no group.")
+    parser.add_argument("--kind", choices=["zscore", "normed"],
+                        default="zscore")
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--nan-fraction", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic PepSIRF-shaped score matrix."
+    )
+    parser.add_argument("output", help="Path of the TSV to write.")
+    add_matrix_arguments(parser)
+    args = parser.parse_args()
+
+    generate_matrix(
+        args.output, args.peptides, args.groups, args.replicates,
+        args.singletons, args.kind, args.noise, args.nan_fraction, args.seed
+    )
+
+
+if __name__ == "__main__":
+    main()
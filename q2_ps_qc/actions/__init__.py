@@ -1,4 +1,5 @@
 #!/usr/bin/env python
 from q2_ps_qc.actions.generate_corr_matrix import generate_corr_matrix
+from q2_ps_qc.actions.threshold_summary import threshold_summary
 
-__all__ = ['generate_corr_matrix']
+__all__ = ['generate_corr_matrix', 'threshold_summary']
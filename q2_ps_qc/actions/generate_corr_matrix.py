@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 
-import altair as alt
-import csv
+import biom
 import numpy as np
 import os
 import pandas as pd
 import qiime2
+import tempfile
 
 from itertools import combinations
 
-from q2_pepsirf.format_types import PepsirfContingencyTSVFormat
+from q2_ps_qc.correlation import (
+    correlation_table, group_log_constants, sparse_correlation_table,
+    sparse_group_log_constants, streaming_correlation_table
+)
+from q2_ps_qc.instrumentation import timed_stage, timings_table
+from q2_ps_qc.score_matrix import (
+    CACHE_MAX_MB, CHUNK_SIZE, column_fingerprints, iter_score_chunks,
+    iter_sparse_chunks, load_cached_score_matrix, load_score_matrix,
+    read_score_samples, score_matrix_from_biom
+)
 from qiime2.plugin import MetadataColumn
 from qiime2.plugin import Metadata
 
@@ -24,49 +33,209 @@ def rfind(pattern, string):
     return new_string
 
 
-def generate_corr_tsv(data, corr_file_name, corr_replicates):
-    score_fh = open(data, "r")
-    corr_fh = open(corr_file_name, "w")
-    scores = score_fh.readlines()
-    replicates = scores[0].replace("\n", "").split("\t")
-    replicates.pop(0)
-
-    corr_fh.write("Sequence name\t")
+def group_replicates(replicates):
+    # Map each base sequence name to the positions of its replicates, in
+    # column order, with a single pass over the replicate names
+    groups = {}
+    for index, replicate in enumerate(replicates):
+        groups.setdefault(rfind("_", replicate), []).append(index)
+    return groups
+
+
+def sample_group_name(group):
+    # Name of a line of the samples file: its replicates, sorted and joined by
+    # commas, so the name does not depend on which of them are in a matrix
+    return ",".join(sorted(set(group)))
+
+
+def sample_groups(user_spec_reps, replicates):
+    # Map each line of the samples file to the positions of its replicates in
+    # the matrix. Lines may share replicates; a line listing the same
+    # replicates as an earlier one adds nothing. Replicates missing from the
+    # matrix are ignored, as are groups left with fewer than two
+    replicate_indexes = {
+        replicate: index for index, replicate in enumerate(replicates)
+    }
+    groups = {}
+    for group in user_spec_reps:
+        name = sample_group_name(group)
+        present = [
+            replicate for replicate in dict.fromkeys(group)
+            if replicate in replicate_indexes
+        ]
+        if name in groups or len(present) < 2:
+            continue
+        groups[name] = [replicate_indexes[replicate] for replicate in present]
+    return groups
 
-    for replicate in corr_replicates[:-1]:
-        corr_fh.write(replicate)
-        corr_fh.write("\t")
-    corr_fh.write(corr_replicates[len(corr_replicates) - 1])
-    corr_fh.write("\n")
 
-    row_index = 1
-    try:
-        while True:
-            # Create a list of all the scores in the current row
-            # Replace all 'nan' values with '0' and remove first element as it is not a score
-            row = scores[row_index].replace("\n", "").replace('nan', '0').split("\t")
+def paired_groups(replicates, user_spec_reps=None):
+    # Groups of at least two replicates: the lines of the samples file when
+    # given, otherwise replicates sharing a base sequence name
+    if user_spec_reps is not None:
+        groups = sample_groups(user_spec_reps, replicates)
+    else:
+        groups = group_replicates(replicates)
+    return {
+        group: positions for group, positions in groups.items()
+        if len(positions) > 1
+    }
+
+
+def group_fingerprints(values, replicates, groups, constants,
+                       correlation_method):
+    # Map (group, replicate) to a fingerprint of the replicate's column, salted
+    # with everything else that affects the group's correlations
+    fingerprints = {}
+    for index, (group, positions) in enumerate(groups.items()):
+        salt = "%s\t%r" % (
+            correlation_method,
+            None if constants is None else float(constants[index])
+        )
+        for position, fingerprint in zip(
+                positions, column_fingerprints(values, positions, salt)):
+            fingerprints[(group, replicates[position])] = fingerprint
+    return fingerprints
+
+
+def reusable_groups(previous_table, replicates, groups, fingerprints):
+    # Names of the groups whose stored pair results are still valid: the
+    # same replicates as before, each with an unchanged fingerprint
+    previous_fingerprints = {}
+    previous_members = {}
+    for pair in previous_table.itertuples(index=False):
+        previous_fingerprints[(pair.group, pair.sample_a)] = pair.fingerprint_a
+        previous_fingerprints[(pair.group, pair.sample_b)] = pair.fingerprint_b
+        previous_members.setdefault(pair.group, set()).update(
+            (pair.sample_a, pair.sample_b)
+        )
+
+    reused = set()
+    for group, positions in groups.items():
+        members = {replicates[position] for position in positions}
+        if previous_members.get(group) == members and all(
+                previous_fingerprints[(group, replicate)]
+                == fingerprints[(group, replicate)]
+                for replicate in members):
+            reused.add(group)
+    return reused
+
+
+def merge_correlations(previous_table, corr_table, groups, reused_groups):
+    # Combine newly computed pairs with the reused pairs from the previous
+    # run, in current group order, keeping previous groups that are not in
+    # this matrix at the end. Those are stored only, never classified
+    reused = previous_table[previous_table["group"].isin(reused_groups)]
+    absent = previous_table[~previous_table["group"].isin(groups)]
+    merged = pd.concat([corr_table, reused], ignore_index=True)
+
+    group_order = {group: index for index, group in enumerate(groups)}
+    merged = merged.iloc[
+        np.argsort(merged["group"].map(group_order).values, kind="stable")
+    ]
+    return pd.concat([merged, absent], ignore_index=True)[corr_table.columns]
+
+
+def pair_status(corr_table, groups, correlation_threshold):
+    # Good/bad status of each pair by its own r. Stored pairs of groups that
+    # are not in this matrix, and pairs whose r is NaN, are unclassified
+    current = corr_table["group"].isin(groups).values
+    r = corr_table["r"].values
+    return np.select(
+        [current & (r < correlation_threshold),
+         current & (r >= correlation_threshold)],
+        ["bad", "good"],
+        "unclassified"
+    )
 
-            # Write the sequence name, then pop the sequence name from the row list
-            corr_fh.write(row[0])
-            row.pop(0)
 
-            # Loop through each score in the row list
-            score_index = 0
-            while score_index < len(row):
-                # Get the name of the replicate associated with the current score
-                replicate = replicates[score_index]
+def replicate_correlations(corr_table, groups, replicate_statistic="mean"):
+    # Map each replicate to the mean or minimum r over all pairs it belongs
+    # to in the groups of this matrix. Stored pairs of other groups, and pairs
+    # whose r is NaN, are skipped
+    corr_table = corr_table[corr_table["group"].isin(groups)]
+    replicate_r = pd.concat([
+        corr_table[["sample_a", "r"]].rename(columns={"sample_a": "replicate"}),
+        corr_table[["sample_b", "r"]].rename(columns={"sample_b": "replicate"})
+    ]).dropna(subset=["r"])
+    return replicate_r.groupby("replicate", sort=False)["r"] \
+        .agg(replicate_statistic).to_dict()
+
+
+def classify_replicates(replicate_r, correlation_threshold):
+    # Map each replicate to "good" or "bad" by comparing its r to the
+    # threshold
+    return {
+        replicate: "bad" if r < correlation_threshold else "good"
+        for replicate, r in replicate_r.items()
+    }
+
+
+def classify_thresholds(replicate_r, replicates, correlation_thresholds):
+    # Classify every replicate against each threshold at once, reusing the
+    # same r values. With more than one threshold, replicates are also put in
+    # a tier: good at or above the highest threshold, bad below the lowest
+    # and marginal in between
+    classified = [rep for rep in replicates if rep in replicate_r]
+    r = np.array([replicate_r[rep] for rep in classified], dtype=np.float64)
+
+    classifications = pd.DataFrame(index=pd.Index(classified, name="sample-id"))
+    classifications["r"] = r
+    for threshold in correlation_thresholds:
+        classifications[str(threshold)] = np.where(r < threshold, "bad", "good")
+
+    if len(set(correlation_thresholds)) > 1:
+        classifications["tier"] = np.select(
+            [r >= max(correlation_thresholds), r < min(correlation_thresholds)],
+            ["good", "bad"],
+            "marginal"
+        )
+
+    return classifications
+
+
+def generate_corr_tsv(chunks, replicates, corr_files):
+    # Write each corr_files entry (file name -> replicates to keep) from the
+    # parsed (peptides, values) chunks in a single pass, selecting columns
+    # with precomputed index arrays and writing whole blocks of rows at once
+    replicate_indexes = {
+        replicate: index for index, replicate in enumerate(replicates)
+    }
+    corr_columns = {
+        corr_file_name: np.array(
+            [replicate_indexes[replicate] for replicate in corr_replicates],
+            dtype=np.intp
+        )
+        for corr_file_name, corr_replicates in corr_files.items()
+    }
+
+    corr_fhs = {
+        corr_file_name: open(corr_file_name, "w")
+        for corr_file_name in corr_files
+    }
+    try:
+        for corr_file_name, corr_fh in corr_fhs.items():
+            corr_fh.write(
+                "\t".join(["Sequence name"] + list(corr_files[corr_file_name]))
+            )
+            corr_fh.write("\n")
 
-                # Check if the replicate matches the replicate in the predicted correlation file
-                if replicate in corr_replicates:
-                    corr_fh.write("\t")
-                    corr_fh.write(row[score_index])
+        for peptides, chunk_values in chunks:
+            for corr_file_name, corr_fh in corr_fhs.items():
+                pd.DataFrame(
+                    chunk_values[:, corr_columns[corr_file_name]],
+                    index=peptides
+                ).to_csv(corr_fh, sep="\t", header=False, na_rep="nan")
+    finally:
+        for corr_fh in corr_fhs.values():
+            corr_fh.close()
 
-                score_index += 1
 
-            corr_fh.write("\n")
-            row_index += 1
-    except EOFError and IndexError:
-        pass
+def _zero_filled(chunks):
+    # Treat missing scores in streamed chunks as 0
+    for peptides, chunk_values in chunks:
+        chunk_values[np.isnan(chunk_values)] = 0
+        yield peptides, chunk_values
 
 
 def generate_metadata(replicates):
@@ -87,13 +256,56 @@ def generate_metadata(replicates):
 
 def generate_corr_matrix(
         ctx,
-        data,
+        scores=None,
+        data=None,
         samples=None,
         log_normalization=False,
-        correlation_threshold=0.8
+        correlation_threshold=0.8,
+        correlation_thresholds=None,
+        streaming=False,
+        chunk_size=CHUNK_SIZE,
+        n_jobs=1,
+        cache_dir=None,
+        cache_max_mb=CACHE_MAX_MB,
+        sparse=False,
+        correlation_method="pearson",
+        replicate_statistic="mean",
+        previous_correlations=None,
+        timing_log=None,
+        scratch_dir=None,
+        nan_policy="zero",
+        reader="python"
 ):
     LN_CONSTANT = 11
 
+    # Wall time, CPU time and peak RSS of each stage of the run
+    timings = []
+
+    if (scores is None) == (data is None):
+        raise ValueError(
+            "Exactly one of a score matrix artifact (scores) or a score"
+            " matrix file (data) must be provided."
+        )
+
+    # Artifacts are already parsed, so they are never streamed or cached;
+    # only artifacts have a sparse representation to keep
+    if scores is not None:
+        streaming = False
+    else:
+        sparse = False
+
+    # Ranks need every score of a column at once
+    if streaming and correlation_method != "pearson":
+        raise ValueError(
+            "Only the pearson correlation method can be used when streaming."
+        )
+
+    # Column fingerprints need every score of a column at once
+    if streaming and previous_correlations is not None:
+        raise ValueError(
+            "Previous correlations cannot be reused when streaming."
+        )
+
     # samples dictionary stores a list of sample replicates at a key defined
     # by the base sequence
     user_spec_pairs = []
@@ -110,190 +322,269 @@ def generate_corr_matrix(
         for group in user_spec_reps:
             user_spec_pairs.extend(list(combinations(group, 2)))
     else: # assume there will be no pairs
+        user_spec_reps = None
         user_spec_pairs = None
 
-    # Open the file with replicate scores
-    score_fh = open(data, "r")
-    scores = score_fh.readlines()
-
-    # Get the names of all the replicates in the input file
-    replicates = scores[0].replace("\n", "").split("\t")
-    replicates.pop(0)
+    with timed_stage(timings, "parse", timing_log):
+        # Only replicates in a group of at least two are ever correlated or
+        # plotted, so only their columns of a file are parsed
+        if data is not None:
+            header = read_score_samples(data)
+            columns = sorted({
+                position
+                for positions in paired_groups(header, user_spec_reps).values()
+                for position in positions
+            })
+
+        if streaming:
+            # Only read the names of the replicates; scores are read in chunks
+            replicates = [header[column] for column in columns]
+        else:
+            # Read the artifact's BIOM table straight into an array, parse the
+            # file with replicate scores once into a 2-D array, or open the
+            # parsed copy kept from a previous run
+            if scores is not None:
+                score_matrix = score_matrix_from_biom(
+                    scores.view(biom.Table), dense=not sparse
+                )
+            elif cache_dir is not None:
+                score_matrix = load_cached_score_matrix(
+                    data, cache_dir, cache_max_mb, columns, reader
+                )
+            else:
+                score_matrix = load_score_matrix(data, columns, reader)
+            replicates = list(score_matrix.samples)
+
+            # Treat missing scores as 0 unless pairs are to be correlated over
+            # their complete rows
+            values = score_matrix.values
+            if sparse:
+                if nan_policy == "zero":
+                    values.data[np.isnan(values.data)] = 0
+                values.eliminate_zeros()
+                values.sort_indices()
+            elif nan_policy == "zero":
+                values[np.isnan(values)] = 0
 
     repScatters_tsv = ctx.get_action('ps-plot', 'repScatters_tsv')
-
-    first_pair_index = 0
-    second_pair_index = 0
-    looking_for_second_pair = False
-    index = 0
-    temp_index = 0
-    distance_between_indices = 0
-    replicate_pair_dict = {}
-    bad_corr_replicates = []
-    good_corr_replicates = []
-    try:
-        while True:
-            current_replicate = replicates[index]
-
-            if not looking_for_second_pair:
-                replicate_pair_dict = {}
-                base_sequence_name = rfind("_", current_replicate)
-
-                temp_index = index
-                first_pair_index = index
-
-                replicate_pair_dict[current_replicate] = []
-
-                looking_for_second_pair = True
-                index += 1
-                continue
-
-            # Check if current replicate has matching base sequence name
-            if looking_for_second_pair and rfind("_", current_replicate) == base_sequence_name:
-                second_pair_index = index
-
-                replicate_pair_dict[current_replicate] = []
-
-                # Loop through each of the rows in the scores file
-                row_index = 1
-                try:
-                    while True:
-                        row = scores[row_index].replace("\n", "").replace('nan', '0').split("\t")
-                        row.pop(0)
-
-                        # Check log normaliztion flag and calculate score from the index associated the first pair
-                        if log_normalization:
-                            if float(row[first_pair_index]) >= LN_CONSTANT:
-                                LN_CONSTANT = float(row[first_pair_index]) + 1
-
-                                row_index = 1
-                                continue
-
-                            first_pair_score = np.log10(float(row[first_pair_index]) + LN_CONSTANT) - np.log10(LN_CONSTANT)
-                        # Otherwise get the score from the index associated with the first pair
-                        else:
-                            first_pair_score = float(row[first_pair_index])
-
-                        # Add score to the first pair entry
-                        replicate_pair_dict[replicates[first_pair_index]].append(first_pair_score)
-
-                        # Check log normaliztion flag and calculate score from the index associated the second pair
-                        if log_normalization:
-                            if float(row[second_pair_index]) >= LN_CONSTANT:
-                                LN_CONSTANT = float(row[second_pair_index]) + 1
-
-                                replicate_pair_dict[replicates[first_pair_index]] = []
-                                replicate_pair_dict[replicates[second_pair_index]] = []
-                                row_index = 1
-                                print("RESETTING SCORE INDEX")
-                                continue
-
-                            second_pair_score = np.log10(float(row[second_pair_index]) + LN_CONSTANT) - np.log10(LN_CONSTANT)
-                        # Otherwise get the score from the index associated with the second pair
-                        else:
-                           second_pair_score = float(row[second_pair_index])
-
-                        # Add score to the second pair entry
-                        replicate_pair_dict[replicates[second_pair_index]].append(second_pair_score)
-
-                        row_index += 1
-
-                except EOFError and IndexError:
-                    pass
-
-                # Create a data frame & convert it into a correlation matrix
-                data_frame = pd.DataFrame(data=replicate_pair_dict)
-                corr_matrix = [data_frame.corr(method='pearson')]
-
-                for matrix in corr_matrix:
-                    score_found = False
-                    temp_score = '2.0'
-                    for replicate in matrix:
-                        # check replicate has not been examined yet
-                        if replicate not in good_corr_replicates \
-                                and replicate not in bad_corr_replicates:
-                            if score_found and temp_score != '2.0':
-                                if float(temp_score) < correlation_threshold:
-                                    bad_corr_replicates.append(replicate)
-                                elif float(temp_score) >= correlation_threshold:
-                                    good_corr_replicates.append(replicate)
-                            for score in matrix.get(replicate):
-                                if score != 1.0 and not score_found:
-                                    temp_score = str(score)
-                                    score_found = True
-
-                                    if score < correlation_threshold:
-                                        bad_corr_replicates.append(replicate)
-                                    elif score >= correlation_threshold:
-                                        good_corr_replicates.append(replicate)
-
-                looking_for_second_pair = False
-
-                if distance_between_indices > 0:
-                    distance_between_indices = 0
-                    index = temp_index
+    threshold_summary = ctx.get_action('ps-qc', 'threshold_summary')
+
+    with timed_stage(timings, "grouping", timing_log):
+        # Group replicates by the samples file when given, otherwise by base
+        # sequence name
+        replicate_groups = paired_groups(replicates, user_spec_reps)
+
+    with timed_stage(timings, "correlation", timing_log):
+        # Correlate every pair of replicates within each group
+        if streaming:
+            # Accumulate per-pair sums over row chunks of the file
+            corr_table = streaming_correlation_table(
+                lambda: iter_score_chunks(data, chunk_size, columns, reader),
+                replicates,
+                replicate_groups,
+                LN_CONSTANT if log_normalization else None,
+                nan_policy
+            )
+            corr_table["fingerprint_a"] = ""
+            corr_table["fingerprint_b"] = ""
+        else:
+            # Derive every group's log normalization constant up front; rank
+            # methods do not depend on log normalization, which keeps the order
+            # of every column's scores
+            constants = None
+            if log_normalization and correlation_method == "pearson":
+                if sparse:
+                    constants = sparse_group_log_constants(
+                        values, list(replicate_groups.values()), LN_CONSTANT
+                    )
+                else:
+                    constants = group_log_constants(
+                        values, list(replicate_groups.values()), LN_CONSTANT
+                    )
+
+            # Fingerprint each column as it will be correlated so a later run
+            # can tell which groups changed
+            fingerprints = group_fingerprints(
+                values, replicates, replicate_groups, constants,
+                correlation_method
+            )
+
+            # Only correlate groups that are new or changed since the previous
+            # run; the rest keep their stored results
+            if previous_correlations is not None:
+                previous_table = previous_correlations.view(pd.DataFrame)
+                reused_groups = reusable_groups(
+                    previous_table, replicates, replicate_groups, fingerprints
+                )
             else:
-                distance_between_indices += 1
-                if index == len(replicates) - 1:
-                    print("Second pair not found; either it's already been found or there is no second pair")
-                    looking_for_second_pair = False
-                    distance_between_indices = 0
-                    index = temp_index
-
-            index += 1
-
-    except EOFError and IndexError:
-        pass
-
-    score_fh.close()
+                previous_table = None
+                reused_groups = set()
+
+            computed_groups = {
+                group: positions
+                for group, positions in replicate_groups.items()
+                if group not in reused_groups
+            }
+            if constants is not None:
+                constants = constants[[
+                    group not in reused_groups for group in replicate_groups
+                ]]
+
+            if sparse:
+                # Accumulate per-pair sums over the nonzero scores only
+                corr_table = sparse_correlation_table(
+                    values,
+                    replicates,
+                    computed_groups,
+                    constants,
+                    correlation_method,
+                    nan_policy
+                )
+            else:
+                # Compute each group's full correlation block in one batch
+                corr_table = correlation_table(
+                    values,
+                    replicates,
+                    computed_groups,
+                    n_jobs,
+                    correlation_method,
+                    constants,
+                    nan_policy
+                )
+            corr_table["fingerprint_a"] = [
+                fingerprints[(pair.group, pair.sample_a)]
+                for pair in corr_table.itertuples(index=False)
+            ]
+            corr_table["fingerprint_b"] = [
+                fingerprints[(pair.group, pair.sample_b)]
+                for pair in corr_table.itertuples(index=False)
+            ]
+
+            # Merge the new results into the stored result set
+            if previous_table is not None:
+                corr_table = merge_correlations(
+                    previous_table, corr_table, replicate_groups, reused_groups
+                )
+
+    with timed_stage(timings, "classification", timing_log):
+        # Record each pair's own good/bad status
+        corr_table["status"] = pair_status(
+            corr_table, replicate_groups, correlation_threshold
+        )
+
+        # Classify each replicate by the mean or minimum r of its pairs, then
+        # align correlation reps to input matrix cols
+        replicate_r = replicate_correlations(
+            corr_table, replicate_groups, replicate_statistic
+        )
+        replicate_status = classify_replicates(
+            replicate_r, correlation_threshold
+        )
+        bad_corr_replicates = [
+            rep for rep in replicates if replicate_status.get(rep) == "bad"
+        ]
+        good_corr_replicates = [
+            rep for rep in replicates if replicate_status.get(rep) == "good"
+        ]
 
-    # align correlation reps to input matrix cols
-    bad_corr_replicates = [rep for rep in replicates if rep in bad_corr_replicates]
-    good_corr_replicates = [rep for rep in replicates if rep in good_corr_replicates]
+        # Classify against correlation_threshold and every additional
+        # threshold from the same correlations
+        correlation_thresholds = [correlation_threshold] + [
+            threshold for threshold in correlation_thresholds or []
+            if threshold != correlation_threshold
+        ]
+        classifications = classify_thresholds(
+            replicate_r, replicates, correlation_thresholds
+        )
+
+    # Write intermediates to a directory of this run's own, so concurrent runs
+    # never share files, and remove it once the visualizations are rendered
+    with tempfile.TemporaryDirectory(
+            prefix="q2-ps-qc-", dir=scratch_dir) as work_dir:
+        bad_corr_file = os.path.join(work_dir, "bad_corr.tsv")
+        good_corr_file = os.path.join(work_dir, "good_corr.tsv")
+
+        with timed_stage(timings, "write_tsv", timing_log):
+            # Create Zscore matrices for bad and good correlation replicates
+            # in one pass over the scores
+            if streaming:
+                score_chunks = iter_score_chunks(
+                    data, chunk_size, columns, reader
+                )
+                if nan_policy == "zero":
+                    score_chunks = _zero_filled(score_chunks)
+            elif sparse:
+                score_chunks = iter_sparse_chunks(score_matrix, chunk_size)
+            else:
+                score_chunks = [(score_matrix.peptides, values)]
+            generate_corr_tsv(
+                score_chunks,
+                replicates,
+                {
+                    bad_corr_file: bad_corr_replicates,
+                    good_corr_file: good_corr_replicates
+                }
+            )
+
+        with timed_stage(timings, "metadata", timing_log):
+            # Create metadata for bad and good correlation replicates
+            bad_metadata = generate_metadata(bad_corr_replicates)
+            good_metadata = generate_metadata(good_corr_replicates)
+
+            # put user pairs in a format qiime2 can work with
+            if user_spec_pairs is not None:
+                bad_corr_spec_pairs = [
+                    rep for pair in user_spec_pairs for rep in pair \
+                    if replicate_status.get(rep) == "bad"
+                ]
+                good_corr_spec_pairs = [
+                    rep for pair in user_spec_pairs for rep in pair \
+                    if replicate_status.get(rep) == "good"
+                ]
+            else:
+                bad_corr_spec_pairs = None
+                good_corr_spec_pairs = None
+
+        with timed_stage(timings, "render", timing_log):
+            bad_correlation_vis, = repScatters_tsv(
+                source = bad_metadata,
+                user_spec_pairs = bad_corr_spec_pairs,
+                pn_filepath = None,
+                plot_log = False,
+                zscore_filepath = bad_corr_file,
+                col_sum_filepath = None,
+                facet_charts = False,
+                xy_threshold = None
+            )
+
+            good_correlation_vis, = repScatters_tsv(
+                source = good_metadata,
+                user_spec_pairs = good_corr_spec_pairs,
+                pn_filepath = None,
+                plot_log = False,
+                zscore_filepath = good_corr_file,
+                col_sum_filepath = None,
+                facet_charts = False,
+                xy_threshold = None
+            )
+
+    # Metadata must have at least one ID
+    if len(classifications):
+        classifications_md = qiime2.Metadata(classifications)
+    else:
+        classifications_md = None
 
-    # Create Zscore matrix and metadata for bad correlation replicates
-    generate_corr_tsv(data, "bad_corr.tsv", bad_corr_replicates)
-    bad_metadata = generate_metadata(bad_corr_replicates)
+    # Embed the cost of every stage so far in the summary and its provenance
+    with timed_stage(timings, "threshold_summary", timing_log):
+        threshold_summary_vis, = threshold_summary(
+            classifications = classifications_md,
+            timings = qiime2.Metadata(timings_table(timings))
+        )
 
-    # Create Zscore matrix and metadata for bad correlation replicates
-    generate_corr_tsv(data, "good_corr.tsv", good_corr_replicates)
-    good_metadata = generate_metadata(good_corr_replicates)
+    correlations = ctx.make_artifact("PairCorrelations", corr_table)
 
-    # put user pairs in a format qiime2 can work with
-    if user_spec_pairs is not None:
-        bad_corr_spec_pairs = [
-            rep for pair in user_spec_pairs for rep in pair \
-            if rep in bad_corr_replicates
-        ]
-        good_corr_spec_pairs = [
-            rep for pair in user_spec_pairs for rep in pair \
-            if rep in good_corr_replicates
-        ]
-    else:
-        bad_corr_spec_pairs = None
-        good_corr_spec_pairs = None
-
-    bad_correlation_vis, = repScatters_tsv(
-		source = bad_metadata,
-        user_spec_pairs = bad_corr_spec_pairs,
-		pn_filepath = None,
-		plot_log = False,
-		zscore_filepath = "bad_corr.tsv",
-		col_sum_filepath = None,
-		facet_charts = False,
-		xy_threshold = None
-	)
-
-    good_correlation_vis, = repScatters_tsv(
-        source = good_metadata,
-        user_spec_pairs = good_corr_spec_pairs,
-        pn_filepath = None,
-        plot_log = False,
-        zscore_filepath = "good_corr.tsv",
-        col_sum_filepath = None,
-        facet_charts = False,
-        xy_threshold = None
+    return (
+        bad_correlation_vis, good_correlation_vis, threshold_summary_vis,
+        correlations
     )
 
-    return bad_correlation_vis, good_correlation_vis
-
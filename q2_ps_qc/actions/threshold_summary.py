@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import os
+import pandas as pd
+import qiime2
+
+
+def threshold_summary(
+        output_dir: str,
+        classifications: qiime2.Metadata = None,
+        timings: qiime2.Metadata = None
+) -> None:
+    with open(os.path.join(output_dir, "index.html"), "w") as html_fh:
+        html_fh.write("<html><body>\n<h1>Replicate classification</h1>\n")
+
+        if classifications is None:
+            html_fh.write("<p>No replicates were classified.</p>\n")
+        else:
+            classifications = classifications.to_dataframe()
+            status_columns = [
+                column for column in classifications.columns if column != "r"
+            ]
+
+            # Number of good, marginal and bad replicates per threshold
+            counts = pd.DataFrame({
+                column: classifications[column].value_counts()
+                for column in status_columns
+            }).fillna(0).astype(int)
+            html_fh.write("<h2>Counts</h2>\n")
+            html_fh.write(counts.to_html())
+
+            html_fh.write("\n<h2>Replicates</h2>\n")
+            html_fh.write(classifications.to_html())
+
+        # Wall time, CPU time and peak RSS of each stage of the run
+        if timings is not None:
+            html_fh.write("\n<h2>Run time by stage</h2>\n")
+            html_fh.write(timings.to_dataframe().to_html())
+
+        html_fh.write("\n</body></html>\n")
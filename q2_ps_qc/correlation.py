@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import combinations
+from multiprocessing import shared_memory
+from scipy import stats
+
+
+def standardize(values):
+    # Center each column and scale it to unit length so that the dot product
+    # of two standardized columns is their Pearson correlation. Columns with
+    # no variance become NaN, matching pandas' corr()
+    centered = values - values.mean(axis=0)
+    norms = np.sqrt(np.einsum("ij,ij->j", centered, centered))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return centered / norms
+
+
+def rank_columns(values):
+    # Rank each column once, giving tied scores their average rank
+    return stats.rankdata(values, axis=0).astype(np.float64, copy=False)
+
+
+def kendall_pair_correlations(values, pairs):
+    # Kendall's tau-b for each pair, using scipy's O(n log n) merge sort
+    # algorithm rather than comparing every pair of peptides
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    return np.array([
+        stats.kendalltau(values[:, first], values[:, second])[0]
+        for first, second in pairs
+    ], dtype=np.float64)
+
+
+def complete_pair_correlations(values, pairs, method="pearson"):
+    # (n, r) for each pair, each computed only over the rows where both of
+    # its columns have a finite score
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    n = np.empty(len(pairs), dtype=np.int64)
+    r = np.empty(len(pairs), dtype=np.float64)
+    for index, (first, second) in enumerate(pairs):
+        x = values[:, first]
+        y = values[:, second]
+        complete = np.isfinite(x) & np.isfinite(y)
+        x = x[complete]
+        y = y[complete]
+
+        n[index] = len(x)
+        if method == "kendall":
+            r[index] = stats.kendalltau(x, y)[0]
+            continue
+        if method == "spearman":
+            x = stats.rankdata(x)
+            y = stats.rankdata(y)
+        x = x - x.mean() if len(x) else x
+        y = y - y.mean() if len(y) else y
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r[index] = (x @ y) / np.sqrt((x @ x) * (y @ y))
+    return n, np.clip(r, -1.0, 1.0)
+
+
+def complete_block_correlations(block):
+    # (n, r) of every pair of columns of block, each over the rows where both
+    # columns have a finite score. Masked products give every pair's sums at
+    # once: with X the scores (missing as 0) and M the presence mask, M.T @ M
+    # counts complete rows, X.T @ M sums x over them and X.T @ X sums xy
+    present = np.isfinite(block)
+    mask = present.astype(np.float64)
+
+    # Shift each column by its mean to avoid cancellation in the sums
+    scores = np.where(present, block - _complete_mean(block, present), 0)
+
+    n = mask.T @ mask
+    sum_x = scores.T @ mask
+    sum_xx = (scores * scores).T @ mask
+    r = _correlation_from_sums(
+        n, sum_x, sum_x.T, sum_xx, sum_xx.T, scores.T @ scores
+    )
+    return n.astype(np.int64), r
+
+
+def group_pairs(groups):
+    # Every within-group (first, second) pair of column positions, group by
+    # group, along with the name of the group each pair belongs to
+    pairs = []
+    pair_groups = []
+    for group, positions in groups.items():
+        for pair in combinations(positions, 2):
+            pairs.append(pair)
+            pair_groups.append(group)
+    return np.array(pairs, dtype=np.intp).reshape(-1, 2), pair_groups
+
+
+def _pair_group_indexes(groups):
+    # Index of the group each pair from group_pairs belongs to
+    sizes = np.array([len(positions) for positions in groups], dtype=np.intp)
+    return np.repeat(np.arange(len(groups)), sizes * (sizes - 1) // 2)
+
+
+def group_correlations(values, groups, constants=None, method="pearson",
+                       nan_policy="zero"):
+    # (n, r) for every within-group pair, in group_pairs order. Each group's
+    # full correlation block comes from one product of its standardized
+    # columns; constants, one per group, log normalize the group's scores
+    # first. With nan_policy "pairwise" each pair only uses the rows where
+    # both replicates have a score; otherwise values must have no NaN.
+    # Either way, scores that log normalization leaves without a logarithm
+    # (those at or below -constant) are left out of their pairs, as pandas'
+    # corr() does
+    n = []
+    r = []
+    for index, positions in enumerate(groups):
+        block = values[:, positions]
+        if constants is not None:
+            block = log_normalize(block, constants[index])
+
+        upper = np.triu_indices(len(positions), k=1)
+        if nan_policy == "pairwise" or not np.isfinite(block).all():
+            if method == "pearson":
+                block_n, block_r = complete_block_correlations(block)
+                block_n, block_r = block_n[upper], block_r[upper]
+            else:
+                block_n, block_r = complete_pair_correlations(
+                    block, np.column_stack(upper), method
+                )
+            n.append(block_n)
+            r.append(block_r)
+            continue
+
+        n.append(np.full(len(upper[0]), len(block), dtype=np.int64))
+        if method == "kendall":
+            r.append(kendall_pair_correlations(block, np.column_stack(upper)))
+            continue
+
+        # Spearman's rho is Pearson's r of the ranks
+        if method == "spearman":
+            block = rank_columns(block)
+
+        standardized = standardize(block)
+        r.append((standardized.T @ standardized)[upper])
+
+    if not r:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    # Guard against rounding pushing |r| slightly past 1
+    return np.concatenate(n), np.clip(np.concatenate(r), -1.0, 1.0)
+
+
+# Score matrix shared with the worker processes of parallel_group_correlations
+_shared_values = None
+_shared_memory = None
+
+
+def _attach_shared_values(name, shape, dtype):
+    global _shared_values, _shared_memory
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_values = np.ndarray(shape, dtype=dtype, buffer=_shared_memory.buf)
+
+
+def _shared_group_correlations(groups, constants, method, nan_policy):
+    return group_correlations(
+        _shared_values, groups, constants, method, nan_policy
+    )
+
+
+def parallel_group_correlations(values, groups, constants=None, n_jobs=1,
+                                method="pearson", nan_policy="zero"):
+    # group_correlations spread over a pool of n_jobs processes. The matrix
+    # is placed in shared memory once and each worker attaches to it, so only
+    # the group positions and the resulting n and r values are pickled
+    if n_jobs <= 1 or len(groups) < 2:
+        return group_correlations(
+            values, groups, constants, method, nan_policy
+        )
+
+    shared = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        shared_values = np.ndarray(values.shape, dtype=values.dtype, buffer=shared.buf)
+        shared_values[...] = values
+
+        # A few blocks of consecutive groups per worker balance uneven groups
+        blocks = np.array_split(np.arange(len(groups)), min(len(groups), n_jobs * 4))
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_attach_shared_values,
+                initargs=(shared.name, values.shape, values.dtype.str)
+        ) as pool:
+            n, r = zip(*pool.map(
+                partial(
+                    _shared_group_correlations,
+                    method=method,
+                    nan_policy=nan_policy
+                ),
+                [[groups[index] for index in block] for block in blocks],
+                [None if constants is None else constants[block] for block in blocks]
+            ))
+
+        del shared_values
+    finally:
+        shared.close()
+        shared.unlink()
+
+    return np.concatenate(n), np.concatenate(r)
+
+
+def _pair_table(samples, pairs, pair_groups, n, r):
+    # Compact pair -> (group, n, r) table, one row per pair in the order given
+    return pd.DataFrame({
+        "sample_a": [samples[index] for index in pairs[:, 0]],
+        "sample_b": [samples[index] for index in pairs[:, 1]],
+        "group": pair_groups,
+        "n": n,
+        "r": r
+    })
+
+
+def correlation_table(values, samples, groups, n_jobs=1, method="pearson",
+                      constants=None, nan_policy="zero"):
+    # Correlation of every within-group pair of groups (group name -> column
+    # positions). constants, one per group as from group_log_constants, log
+    # normalize each group's scores first. nan_policy "pairwise" correlates
+    # each pair over the rows where both have a score; "zero" expects missing
+    # scores to have been replaced with 0
+    n, r = parallel_group_correlations(
+        values, list(groups.values()), constants, n_jobs, method, nan_policy
+    )
+    pairs, pair_groups = group_pairs(groups)
+    return _pair_table(samples, pairs, pair_groups, n, r)
+
+
+def _score_records(scores, previous_max=-np.inf):
+    # Scores strictly greater than every score before them (in row-major
+    # order), including those summarized by previous_max. Only these can
+    # raise the log normalization constant, since a raised constant is
+    # always larger than every score already seen
+    scores = np.ravel(scores)
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if len(scores) == 0:
+        return scores
+
+    running_max = np.maximum.accumulate(scores)
+    is_record = np.empty(len(scores), dtype=bool)
+    is_record[0] = scores[0] > previous_max
+    is_record[1:] = scores[1:] > np.maximum(running_max[:-1], previous_max)
+    return scores[is_record]
+
+
+def _raise_constant(records, constant):
+    for score in records:
+        if score >= constant:
+            constant = score + 1
+    return constant
+
+
+def log_constant(scores, constant):
+    # Constant for log normalization: scanning the scores in row-major order,
+    # any score >= the constant raises it to that score + 1. Equivalent to
+    # restarting the scan after every raise, but linear in the number of
+    # scores
+    return _raise_constant(_score_records(scores), constant)
+
+
+def group_log_constants(values, groups, constant):
+    # log_constant of each group's block of scores in turn, carrying the
+    # constant over from one group to the next
+    constants = np.empty(len(groups), dtype=np.float64)
+    for index, positions in enumerate(groups):
+        constant = log_constant(values[:, positions], constant)
+        constants[index] = constant
+    return constants
+
+
+def log_normalize(scores, constant):
+    # Scores at or below -constant have no logarithm and become NaN or -inf
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log10(scores + constant) - np.log10(constant)
+
+
+def _stream_log_constants(read_chunks, groups, constant):
+    # First streaming pass for log normalization: collect each group's score
+    # records chunk by chunk, then resolve the constants group by group,
+    # carrying the constant over exactly as group_log_constants does
+    records = [[] for _ in range(len(groups))]
+    running_max = np.full(len(groups), -np.inf)
+
+    for _, chunk in read_chunks():
+        chunk[np.isnan(chunk)] = 0
+        for index, positions in enumerate(groups):
+            group_records = _score_records(
+                chunk[:, positions], running_max[index]
+            )
+            if len(group_records):
+                records[index].append(group_records)
+                running_max[index] = group_records[-1]
+
+    constants = np.empty(len(groups), dtype=np.float64)
+    for index, group_records in enumerate(records):
+        for chunk_records in group_records:
+            constant = _raise_constant(chunk_records, constant)
+        constants[index] = constant
+    return constants
+
+
+def streaming_correlation_table(read_chunks, samples, groups, ln_constant=None,
+                                nan_policy="zero"):
+    # Pearson r for each within-group pair without holding the whole matrix:
+    # read_chunks() returns a fresh iterator of (peptides, values) row blocks,
+    # and only the sufficient statistics n, Σx, Σy, Σx², Σy² and Σxy are kept
+    # per pair. Passing ln_constant log normalizes the scores, which takes one
+    # extra pass to derive the constants. Missing scores count as 0, or with
+    # nan_policy "pairwise" the rows missing either score are left out of a
+    # pair's sums
+    pairs, pair_groups = group_pairs(groups)
+    group_positions = list(groups.values())
+
+    if ln_constant is not None:
+        constants = _stream_log_constants(
+            read_chunks, group_positions, ln_constant
+        )[_pair_group_indexes(group_positions)]
+
+    n = np.zeros(len(pairs), dtype=np.int64)
+    shift_x = shift_y = None
+    sum_x = np.zeros(len(pairs))
+    sum_y = np.zeros(len(pairs))
+    sum_xx = np.zeros(len(pairs))
+    sum_yy = np.zeros(len(pairs))
+    sum_xy = np.zeros(len(pairs))
+
+    for _, chunk in read_chunks():
+        if nan_policy != "pairwise":
+            # Treat missing scores as 0
+            chunk[np.isnan(chunk)] = 0
+
+        x = chunk[:, pairs[:, 0]]
+        y = chunk[:, pairs[:, 1]]
+        if ln_constant is not None:
+            x = log_normalize(x, constants)
+            y = log_normalize(y, constants)
+        complete = np.isfinite(x) & np.isfinite(y)
+
+        # Shift by the first chunk's means to avoid cancellation in the sums
+        if shift_x is None:
+            shift_x = _complete_mean(x, complete)
+            shift_y = _complete_mean(y, complete)
+        x = np.where(complete, x - shift_x, 0)
+        y = np.where(complete, y - shift_y, 0)
+
+        n += complete.sum(axis=0)
+        sum_x += x.sum(axis=0)
+        sum_y += y.sum(axis=0)
+        sum_xx += np.einsum("ij,ij->j", x, x)
+        sum_yy += np.einsum("ij,ij->j", y, y)
+        sum_xy += np.einsum("ij,ij->j", x, y)
+
+    r = _correlation_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+    return _pair_table(samples, pairs, pair_groups, n, r)
+
+
+def _complete_mean(x, complete):
+    # Mean of each column of x over its complete rows, 0 where there are none
+    counts = complete.sum(axis=0)
+    totals = np.where(complete, x, 0).sum(axis=0)
+    return np.divide(
+        totals, counts, out=np.zeros(len(counts)), where=counts > 0
+    )
+
+
+def _correlation_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy):
+    # Pearson r from the sufficient statistics of each pair
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sum_xy - sum_x * sum_y / n
+        var_x = sum_xx - sum_x * sum_x / n
+        var_y = sum_yy - sum_y * sum_y / n
+        r = cov / np.sqrt(var_x * var_y)
+
+    # Columns with no variance have no correlation, matching pandas' corr()
+    r[(var_x <= 0) | (var_y <= 0)] = np.nan
+
+    return np.clip(r, -1.0, 1.0)
+
+
+def sparse_group_log_constants(matrix, groups, constant):
+    # Log normalization constants for a CSC matrix, scanning only stored
+    # entries. Zeros never raise the constant, which starts positive, so the
+    # row-major scan of each group only needs its nonzero scores, ordered by
+    # row and then by column within the group
+    constants = np.empty(len(groups), dtype=np.float64)
+    for index, positions in enumerate(groups):
+        column_slices = [
+            slice(matrix.indptr[column], matrix.indptr[column + 1])
+            for column in positions
+        ]
+        order = np.argsort(
+            np.concatenate([
+                matrix.indices[column_slice] * len(positions) + offset
+                for offset, column_slice in enumerate(column_slices)
+            ]),
+            kind="stable"
+        )
+        group_scores = np.concatenate([
+            matrix.data[column_slice] for column_slice in column_slices
+        ])[order]
+        constant = log_constant(group_scores, constant)
+        constants[index] = constant
+    return constants
+
+
+def _sparse_log_normalize(matrix, constants):
+    # Log normalize each column of a CSC matrix with its own constant. Zeros
+    # map to zero, so only the stored entries change
+    matrix = matrix.copy()
+    column_constants = np.repeat(constants, np.diff(matrix.indptr))
+    matrix.data = log_normalize(matrix.data, column_constants)
+    return matrix
+
+
+def _sparse_rank_columns(matrix):
+    # Ranks of each column of a CSC matrix, shifted so that zeros rank 0 and
+    # the result stays sparse. Every zero in a column shares one average rank,
+    # so only the stored entries need ranking; the shift does not change any
+    # correlation
+    matrix = matrix.copy()
+    n = matrix.shape[0]
+    for column in range(matrix.shape[1]):
+        column_slice = slice(matrix.indptr[column], matrix.indptr[column + 1])
+        scores = matrix.data[column_slice]
+        zeros = n - len(scores)
+        negatives = np.count_nonzero(scores < 0)
+
+        ranks = stats.rankdata(scores)
+        ranks[scores > 0] += zeros
+        matrix.data[column_slice] = ranks - (negatives + (zeros + 1) / 2)
+    return matrix
+
+
+def _sparse_missing(matrix):
+    # Split a CSC matrix into its scores, with missing (non-finite) ones
+    # dropped, and a matrix of 1 wherever a score is missing
+    missing = matrix.copy()
+    missing.data = (~np.isfinite(missing.data)).astype(np.float64)
+    missing.eliminate_zeros()
+
+    matrix = matrix.copy()
+    matrix.data[~np.isfinite(matrix.data)] = 0
+    matrix.eliminate_zeros()
+    return matrix, missing
+
+
+def _column_sums(matrix):
+    return np.asarray(matrix.sum(axis=0)).ravel()
+
+
+def sparse_correlation_table(matrix, samples, groups, constants=None,
+                             method="pearson", nan_policy="zero"):
+    # Pearson r for each within-group pair of a CSC matrix with sorted
+    # indices and no stored zeros, using only its nonzero entries: zeros add
+    # nothing to Σx, Σy, Σx², Σy² or Σxy, and are accounted for by n being
+    # the full number of rows. constants, one per group as from
+    # sparse_group_log_constants, log normalize each group's scores first.
+    # With nan_policy "pairwise", stored NaNs mark missing scores and each
+    # pair's sums leave out the rows where either score is missing
+    pairs, pair_groups = group_pairs(groups)
+    group_positions = list(groups.values())
+
+    # Rank methods need each pair's scores together
+    if method == "kendall" or (
+            method == "spearman" and nan_policy == "pairwise"):
+        columns, positions = np.unique(pairs.ravel(), return_inverse=True)
+        values = matrix[:, columns].toarray()
+        positions = positions.reshape(-1, 2)
+        if nan_policy == "pairwise":
+            n, r = complete_pair_correlations(values, positions, method)
+        else:
+            n = matrix.shape[0]
+            r = kendall_pair_correlations(values, positions)
+        return _pair_table(samples, pairs, pair_groups, n, r)
+    if method == "spearman":
+        matrix = _sparse_rank_columns(matrix)
+        matrix.eliminate_zeros()
+
+    x = matrix[:, pairs[:, 0]]
+    y = matrix[:, pairs[:, 1]]
+    if constants is not None:
+        pair_constants = np.asarray(constants)[_pair_group_indexes(group_positions)]
+        x = _sparse_log_normalize(x, pair_constants)
+        y = _sparse_log_normalize(y, pair_constants)
+
+    n = matrix.shape[0]
+    if nan_policy == "pairwise" or not (
+            np.isfinite(x.data).all() and np.isfinite(y.data).all()):
+        # Take each score's contribution from the rows where the other score
+        # of the pair is missing, or has no logarithm, back out of the column
+        # sums
+        x, x_missing = _sparse_missing(x)
+        y, y_missing = _sparse_missing(y)
+        n = n - _column_sums(x_missing) - _column_sums(y_missing) \
+            + _column_sums(x_missing.multiply(y_missing))
+        xx = x.multiply(x)
+        yy = y.multiply(y)
+        r = _correlation_from_sums(
+            n,
+            _column_sums(x) - _column_sums(x.multiply(y_missing)),
+            _column_sums(y) - _column_sums(y.multiply(x_missing)),
+            _column_sums(xx) - _column_sums(xx.multiply(y_missing)),
+            _column_sums(yy) - _column_sums(yy.multiply(x_missing)),
+            _column_sums(x.multiply(y))
+        )
+        return _pair_table(
+            samples, pairs, pair_groups, n.astype(np.int64), r
+        )
+
+    r = _correlation_from_sums(
+        n,
+        _column_sums(x),
+        _column_sums(y),
+        _column_sums(x.multiply(x)),
+        _column_sums(y.multiply(y)),
+        _column_sums(x.multiply(y))
+    )
+    return _pair_table(samples, pairs, pair_groups, n, r)
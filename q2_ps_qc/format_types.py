@@ -1,6 +1,27 @@
-""""#!/usr/bin/env python
+#!/usr/bin/env python
 import qiime2.plugin.model as model
 from qiime2.plugin import SemanticType
 
-from q2_ps_qc.plugin_setup import plugin"""
+# Per-pair replicate correlation results
+PairCorrelations = SemanticType("PairCorrelations")
 
+PAIR_CORRELATIONS_COLUMNS = [
+    "sample_a", "sample_b", "group", "n", "r", "status",
+    "fingerprint_a", "fingerprint_b"
+]
+
+
+class PairCorrelationsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            header = fh.readline().rstrip("\n").split("\t")
+        if header != PAIR_CORRELATIONS_COLUMNS:
+            raise model.ValidationError(
+                "Expected the header %s, found %s"
+                % ("\t".join(PAIR_CORRELATIONS_COLUMNS), "\t".join(header))
+            )
+
+
+PairCorrelationsDirFmt = model.SingleFileDirectoryFormat(
+    "PairCorrelationsDirFmt", "pair-correlations.tsv", PairCorrelationsFormat
+)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+import json
+import os
+import pandas as pd
+import resource
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Seconds between samples of the process's resident memory
+RSS_SAMPLE_INTERVAL = 0.01
+
+# Cost of one stage of a run. cpu_seconds includes worker processes that
+# finished during the stage. peak_rss_mb is the highest resident memory of
+# this process sampled during the stage. peak_worker_rss_mb is the largest
+# worker process that finished during the stage, 0 when none did; the
+# operating system only keeps the largest worker of the run so far, which it
+# is reported as
+StageTiming = namedtuple(
+    "StageTiming",
+    ["stage", "wall_seconds", "cpu_seconds", "peak_rss_mb",
+     "peak_worker_rss_mb"]
+)
+
+
+def _children_usage():
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def _cpu_seconds():
+    # CPU time used by this process and its finished child processes
+    cpu_seconds = 0.0
+    for usage in (resource.getrusage(resource.RUSAGE_SELF), _children_usage()):
+        cpu_seconds += usage.ru_utime + usage.ru_stime
+    return cpu_seconds
+
+
+def _maxrss_mb(usage):
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return usage.ru_maxrss / 1024 / 1024
+    return usage.ru_maxrss / 1024
+
+
+def _current_rss_mb():
+    # Resident memory of this process right now, or None where /proc is not
+    # available
+    try:
+        with open("/proc/self/statm", "r") as statm_fh:
+            pages = int(statm_fh.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+class _PeakRSSSampler:
+    # Highest resident memory of this process between start() and stop(),
+    # sampled by a background thread. Without /proc it falls back to the
+    # process's lifetime high-water mark
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._peak = None
+        self._thread = None
+
+    def _sample(self):
+        rss = _current_rss_mb()
+        if rss is not None and (self._peak is None or rss > self._peak):
+            self._peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        if self._peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        if self._peak is None:
+            return _maxrss_mb(resource.getrusage(resource.RUSAGE_SELF))
+        return self._peak
+
+
+@contextmanager
+def timed_stage(timings, stage, log_path=None):
+    # Append the StageTiming of the enclosed block to timings and, when
+    # log_path is given, append it to that file as one JSON line
+    sampler = _PeakRSSSampler()
+    sampler.start()
+    children_start = _children_usage()
+    wall_start = time.perf_counter()
+    cpu_start = _cpu_seconds()
+    try:
+        yield
+    finally:
+        peak_rss_mb = sampler.stop()
+
+    # Only count workers if some finished during this stage
+    children_end = _children_usage()
+    peak_worker_rss_mb = 0.0
+    if (children_end.ru_utime + children_end.ru_stime
+            > children_start.ru_utime + children_start.ru_stime):
+        peak_worker_rss_mb = _maxrss_mb(children_end)
+
+    timing = StageTiming(
+        stage,
+        time.perf_counter() - wall_start,
+        _cpu_seconds() - cpu_start,
+        peak_rss_mb,
+        peak_worker_rss_mb
+    )
+    timings.append(timing)
+
+    if log_path is not None:
+        with open(log_path, "a") as log_fh:
+            log_fh.write(json.dumps(timing._asdict()))
+            log_fh.write("\n")
+
+
+def timings_table(timings):
+    # StageTimings as a DataFrame indexed by stage name, suitable for
+    # qiime2.Metadata
+    table = pd.DataFrame(
+        [timing[1:] for timing in timings],
+        index=pd.Index([timing.stage for timing in timings], name="id"),
+        columns=StageTiming._fields[1:]
+    )
+    return table.round(3)
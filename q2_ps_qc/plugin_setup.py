@@ -8,7 +8,7 @@ from qiime2.plugin import (
     Int, Range, MetadataColumn,
     Categorical, Str, List,
     Visualization, Metadata, Bool, 
-    Float
+    Float, Choices
 )
 from q2_pepsirf.format_types import (
     Normed, Zscore, InfoSumOfProbes,
@@ -16,6 +16,9 @@ from q2_pepsirf.format_types import (
     MutantReference
 )
 from q2_types.feature_table import FeatureTable, BIOMV210DirFmt
+from q2_ps_qc.format_types import (
+    PairCorrelations, PairCorrelationsFormat, PairCorrelationsDirFmt
+)
 
 
 # This is the plugin object. It is what the framework will load and what an
@@ -27,32 +30,127 @@ plugin = Plugin(
     description = "Qiime2 Plug-in for the creation of correlation visualizations from PepSIRF outputs."
 )
 
+plugin.register_formats(PairCorrelationsFormat, PairCorrelationsDirFmt)
+plugin.register_semantic_types(PairCorrelations)
+plugin.register_semantic_type_to_format(
+    PairCorrelations, artifact_format=PairCorrelationsDirFmt
+)
+
 plugin.pipelines.register_function(
     function = actions.generate_corr_matrix,
-    inputs = {},
-    input_descriptions = None,
+    inputs = {
+        "scores": FeatureTable[Zscore | Normed],
+        "previous_correlations": PairCorrelations
+    },
+    input_descriptions = {
+        "scores": "Score matrix artifact to check, read directly from its"
+            " BIOM table. Provide either this or data.",
+        "previous_correlations": "Correlation output of a previous run on an"
+            " earlier version of the same matrix. Only groups with new or"
+            " changed replicates are correlated again; the rest reuse the"
+            " stored results. Cannot be used when streaming.",
+    },
     parameters = {
         "data": Str,
         "samples": Str,
         "log_normalization": Bool,
-        "correlation_threshold": Float
+        "correlation_threshold": Float,
+        "correlation_thresholds": List[Float],
+        "streaming": Bool,
+        "chunk_size": Int % Range(1, None),
+        "n_jobs": Int % Range(1, None),
+        "cache_dir": Str,
+        "cache_max_mb": Int % Range(1, None),
+        "sparse": Bool,
+        "correlation_method": Str % Choices("pearson", "spearman", "kendall"),
+        "replicate_statistic": Str % Choices("mean", "min"),
+        "timing_log": Str,
+        "scratch_dir": Str,
+        "nan_policy": Str % Choices("zero", "pairwise"),
+        "reader": Str % Choices("python", "pandas", "pyarrow")
     },
     parameter_descriptions = {
-		"data": "Name of input file.",
+		"data": "Name of input file. Provide either this or scores. gzip,"
+            " bzip2, xz and (with the zstandard package) zstd compressed files"
+            " are detected and decompressed while they are read.",
         "samples": "The name of the tab-delimited file containing sample"
             " information, denoting which samples, in the input matrices, are"
             " replicates. This file must be tab-delimited with each line"
-            " containing a set of replicates.",
+            " containing a set of replicates. When given, these sets are"
+            " correlated instead of grouping samples by base name. Lines may"
+            " share replicates. Each set's group is named by its replicates,"
+            " sorted and joined by commas.",
         "log_normalization": "Run a log normalization on each of the sets of"
             " scores before running a correlation test on them.",
         "correlation_threshold": "Set a threshold value; anything below the"
             " value will be considered a bad correlation score, and anything"
             " above will be considered a good correlation score.",
+        "correlation_thresholds": "Additional thresholds to classify"
+            " replicates against, reusing the same correlations. The threshold"
+            " summary reports each replicate's status at every threshold and,"
+            " when there is more than one threshold, a good/marginal/bad tier."
+            " correlation_threshold, which the good and bad visualizations"
+            " use, is always included.",
+        "streaming": "Read the input file in chunks of rows and accumulate"
+            " per-pair sums instead of loading the whole matrix into memory."
+            " Useful for matrices that do not fit in RAM.",
+        "chunk_size": "Number of rows read at a time when streaming is"
+            " enabled. Peak memory is bounded by this value times the number"
+            " of columns.",
+        "n_jobs": "Number of processes used to compute replicate"
+            " correlations. Workers share the parsed matrix through shared"
+            " memory. Has no effect when streaming is enabled.",
+        "cache_dir": "Directory in which to keep parsed copies of input"
+            " matrices. A repeat run on an unchanged file (same path,"
+            " modification time and size) opens the cached copy instead of"
+            " parsing the text again. Has no effect when streaming is"
+            " enabled.",
+        "cache_max_mb": "Size limit, in megabytes, of the cache directory."
+            " Least recently used matrices are removed once it is exceeded.",
+        "sparse": "Keep a scores artifact in its sparse form and compute"
+            " correlations from its nonzero entries only. Recommended for"
+            " mostly-zero matrices such as normalized counts. Has no effect"
+            " when data is used.",
+        "correlation_method": "Correlation coefficient to compare replicates"
+            " with. spearman and kendall are rank based and less sensitive to"
+            " heavy-tailed scores; neither can be used when streaming.",
+        "replicate_statistic": "How a replicate's correlations with the other"
+            " replicates of its group are combined before comparing to the"
+            " threshold: their mean or their minimum.",
+        "timing_log": "File to append the wall time, CPU time and peak memory"
+            " of each stage of the run to, one JSON object per line. The same"
+            " timings are always shown in the threshold summary.",
+        "scratch_dir": "Directory in which each run creates its own temporary"
+            " directory for intermediate files, for example a fast local disk"
+            " or tmpfs. The temporary directory is removed once the"
+            " visualizations are rendered. Defaults to the system temporary"
+            " directory.",
+        "nan_policy": "How missing (nan) scores are handled. zero treats them"
+            " as 0. pairwise correlates each pair of replicates over only the"
+            " peptides scored in both, and reports that number as the pair's"
+            " n. With pairwise, missing scores are also kept as nan in the"
+            " scatter plot inputs.",
+        "reader": "How a data file is parsed. python is the built-in reader."
+            " pandas uses pandas' C parser. pyarrow parses the file on all"
+            " cores and is fastest for large matrices; it falls back to"
+            " pandas when pyarrow is not installed. All readers also work"
+            " when streaming.",
     },
-    outputs = [("bad_output", Visualization), ("good_output", Visualization)],
+    outputs = [
+        ("bad_output", Visualization),
+        ("good_output", Visualization),
+        ("threshold_output", Visualization),
+        ("correlation_output", PairCorrelations)
+    ],
 	output_descriptions = {
         "bad_output": "File name for bad correlation visualization",
-        "good_output": "File name for good correlation visualization"
+        "good_output": "File name for good correlation visualization",
+        "threshold_output": "Table of each replicate's correlation and"
+            " classification at every threshold, and the time and memory"
+            " taken by each stage of the run",
+        "correlation_output": "Table of every replicate pair with its group,"
+            " number of peptides compared, correlation, good/bad status and"
+            " column fingerprints used for incremental runs"
     },
     name = "Generate Correlation Matrix",
     description = "Finds all replicate pairs that have poor correlation and"
@@ -60,3 +158,24 @@ plugin.pipelines.register_function(
         " scatter plot."
 )
 
+
+plugin.visualizers.register_function(
+    function = actions.threshold_summary,
+    inputs = {},
+    input_descriptions = None,
+    parameters = {
+        "classifications": Metadata,
+        "timings": Metadata
+    },
+    parameter_descriptions = {
+        "classifications": "Replicate correlations and their classification"
+            " at each threshold, as produced by generate-corr-matrix.",
+        "timings": "Wall time, CPU time and peak memory of each stage of a"
+            " generate-corr-matrix run.",
+    },
+    name = "Threshold Summary",
+    description = "Tabulates how replicates are classified at one or more"
+        " correlation thresholds."
+)
+
+importlib.import_module("q2_ps_qc.transformers")
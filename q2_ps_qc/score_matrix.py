@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+import bz2
+import csv
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import numpy as np
+import os
+import pandas as pd
+import queue
+import tempfile
+import threading
+import warnings
+
+from collections import namedtuple
+from itertools import islice
+from operator import itemgetter
+
+# A parsed PepSIRF score matrix: peptide names (rows), sample names (columns)
+# and a float64 array of shape (len(peptides), len(samples))
+ScoreMatrix = namedtuple("ScoreMatrix", ["peptides", "samples", "values"])
+
+# Default number of rows parsed at a time when streaming a matrix
+CHUNK_SIZE = 10000
+
+# Default size limit, in megabytes, of a parsed matrix cache directory
+CACHE_MAX_MB = 10240
+
+# Tokens read as a missing score by the pandas and pyarrow readers, which do
+# not otherwise treat 'nan' the way float() does
+NAN_TOKENS = ["nan", "NaN", "NAN", "-nan", "-NaN"]
+
+# Size, in bytes, of each block decompressed ahead of the parser, and the
+# number of blocks that may be waiting to be parsed
+PREFETCH_BLOCK_SIZE = 1024 * 1024
+PREFETCH_DEPTH = 8
+
+
+def _open_zstd(data):
+    # zstd support needs the optional zstandard package
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            "%s is zstd compressed; install the zstandard package to read"
+            " it." % data
+        )
+    return zstandard.open(data, "rb")
+
+
+# Leading bytes of each supported compression format, with the function
+# opening a file in that format as a decompressed binary stream
+COMPRESSIONS = [
+    ("gzip", b"\x1f\x8b", lambda data: gzip.open(data, "rb")),
+    ("bz2", b"BZh", lambda data: bz2.open(data, "rb")),
+    ("xz", b"\xfd7zXZ\x00", lambda data: lzma.open(data, "rb")),
+    ("zstd", b"\x28\xb5\x2f\xfd", _open_zstd)
+]
+
+
+class _PrefetchReader(io.RawIOBase):
+    # Binary stream over a decompressing file object, read ahead by a
+    # background thread. gzip, bz2 and lzma release the GIL while they
+    # decompress, so decompression overlaps parsing
+    def __init__(self, fh, block_size=PREFETCH_BLOCK_SIZE,
+                 depth=PREFETCH_DEPTH):
+        super().__init__()
+        self._fh = fh
+        self._blocks = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._pending = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(
+            target=self._prefetch, args=(block_size,), daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item):
+        # Queue item unless the reader is closed first
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _prefetch(self, block_size):
+        # An empty block marks the end of the stream; errors are handed over
+        # to be raised by the reading thread
+        try:
+            while True:
+                block = self._fh.read(block_size)
+                if not self._put(block) or not block:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not len(self._pending):
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self._eof = True
+                return 0
+            self._pending = memoryview(block)
+
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fh.close()
+        super().close()
+
+
+def detect_compression(data):
+    # Name of the compression format of a file, from its leading bytes, or
+    # None when it is not compressed
+    with open(data, "rb") as data_fh:
+        magic = data_fh.read(8)
+    for name, signature, _ in COMPRESSIONS:
+        if magic.startswith(signature):
+            return name
+    return None
+
+
+def open_score_file(data, mode="r"):
+    # Open a matrix file for reading as text ("r") or bytes ("rb"). gzip,
+    # bzip2, xz and zstd files are detected by their leading bytes and
+    # decompressed on the fly, so they never need to be expanded on disk
+    compression = detect_compression(data)
+    if compression is None:
+        return open(data, mode)
+
+    opener = {name: opener for name, _, opener in COMPRESSIONS}[compression]
+    score_fh = io.BufferedReader(
+        _PrefetchReader(opener(data)), buffer_size=PREFETCH_BLOCK_SIZE
+    )
+    if mode == "rb":
+        return score_fh
+    return io.TextIOWrapper(score_fh)
+
+
+def _row_parser(columns=None):
+    # Function splitting a line of the matrix into its peptide name and the
+    # score array of the given columns (all of them when None). With columns,
+    # splitting stops after the last one needed and only their fields are
+    # converted
+    if columns is None:
+        def parse_row(line):
+            row = line.rstrip("\n").split("\t")
+            return row[0], np.array(row[1:], dtype=np.float64)
+        return parse_row
+
+    if not columns:
+        def parse_row(line):
+            return line.rstrip("\n").split("\t", 1)[0], np.empty(0)
+        return parse_row
+
+    # Field 0 is the peptide name; anything after the last field needed is
+    # left unsplit in one trailing field
+    max_split = max(columns) + 2
+    get_scores = itemgetter(*[column + 1 for column in columns])
+    single = len(columns) == 1
+
+    def parse_row(line):
+        row = line.rstrip("\n").split("\t", max_split)
+        scores = get_scores(row)
+        if single:
+            scores = (scores,)
+        return row[0], np.array(scores, dtype=np.float64)
+    return parse_row
+
+
+def _read_samples(score_fh):
+    # Get the names of all the replicates from the header line
+    samples = score_fh.readline().rstrip("\n").split("\t")
+    samples.pop(0)
+    return samples
+
+
+def read_score_samples(data):
+    with open_score_file(data) as score_fh:
+        return _read_samples(score_fh)
+
+
+def _read_order(columns, n_columns):
+    # The columns to read, in file order, and the positions that put them
+    # back in the order requested
+    if columns is None:
+        return list(range(n_columns)), None
+    read_columns = sorted(set(columns))
+    read_indexes = {column: index for index, column in enumerate(read_columns)}
+    return read_columns, [read_indexes[column] for column in columns]
+
+
+def _python_chunks(data, chunk_size, columns):
+    # Pure Python reader: split each line and convert the fields kept
+    parse_row = _row_parser(columns)
+    with open_score_file(data) as score_fh:
+        _read_samples(score_fh)
+        lines = (line for line in score_fh if line.strip())
+
+        while True:
+            block = list(islice(lines, chunk_size))
+            if not block:
+                break
+
+            peptides = []
+            rows = []
+            for line in block:
+                peptide, row = parse_row(line)
+                peptides.append(peptide)
+                rows.append(row)
+
+            yield peptides, np.vstack(rows)
+
+
+def _pandas_chunks(data, chunk_size, columns):
+    # pandas' C tokenizer, which skips the fields of unused columns without
+    # converting them
+    read_columns, order = _read_order(columns, len(read_score_samples(data)))
+    score_columns = [column + 1 for column in read_columns]
+    dtypes = {column: np.float64 for column in score_columns}
+    dtypes[0] = str
+    with open_score_file(data) as score_fh:
+        try:
+            frames = pd.read_csv(
+                score_fh,
+                sep="\t",
+                header=None,
+                skiprows=1,
+                index_col=0,
+                usecols=[0] + score_columns,
+                dtype=dtypes,
+                na_values={column: NAN_TOKENS for column in score_columns},
+                keep_default_na=False,
+                quoting=csv.QUOTE_NONE,
+                engine="c",
+                chunksize=chunk_size
+            )
+        except pd.errors.EmptyDataError:
+            return
+        if chunk_size is None:
+            frames = [frames]
+
+        for frame in frames:
+            values = frame.to_numpy(dtype=np.float64)
+            if order is not None:
+                values = values[:, order]
+            yield frame.index.tolist(), values
+
+
+def _pyarrow_chunks(data, chunk_size, columns):
+    # pyarrow's multithreaded CSV reader, which parses blocks of the file on
+    # all cores straight into columnar arrays. Falls back to pandas when
+    # pyarrow is not installed
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        warnings.warn(
+            "pyarrow is not installed, reading the score matrix with pandas"
+            " instead."
+        )
+        yield from _pandas_chunks(data, chunk_size, columns)
+        return
+
+    # Name columns by position, since sample names may repeat
+    n_columns = len(read_score_samples(data))
+    read_columns, order = _read_order(columns, n_columns)
+    names = ["c%d" % index for index in range(n_columns + 1)]
+    score_names = [names[column + 1] for column in read_columns]
+
+    read_options = pa_csv.ReadOptions(
+        column_names=names, skip_rows=1, use_threads=True
+    )
+    parse_options = pa_csv.ParseOptions(delimiter="\t", quote_char=False)
+    column_types = {name: pa.float64() for name in score_names}
+    column_types[names[0]] = pa.string()
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=[names[0]] + score_names,
+        column_types=column_types,
+        null_values=NAN_TOKENS,
+        strings_can_be_null=False
+    )
+
+    with open_score_file(data, "rb") as score_fh:
+        if chunk_size is None:
+            batches = pa_csv.read_csv(
+                score_fh, read_options, parse_options, convert_options
+            ).combine_chunks().to_batches()
+        else:
+            batches = pa_csv.open_csv(
+                score_fh, read_options, parse_options, convert_options
+            )
+
+        for batch in batches:
+            step = chunk_size or max(batch.num_rows, 1)
+            for start in range(0, batch.num_rows, step):
+                part = batch.slice(start, step)
+                values = np.empty((part.num_rows, len(score_names)))
+                for index in range(len(score_names)):
+                    values[:, index] = part.column(index + 1).to_numpy(
+                        zero_copy_only=False
+                    )
+                if order is not None:
+                    values = values[:, order]
+                yield part.column(0).to_pylist(), values
+
+
+# Score matrix readers selectable by name
+READERS = {
+    "python": _python_chunks,
+    "pandas": _pandas_chunks,
+    "pyarrow": _pyarrow_chunks
+}
+
+
+def iter_score_chunks(data, chunk_size=CHUNK_SIZE, columns=None,
+                      reader="python"):
+    # Yield (peptides, values) for consecutive blocks of at most chunk_size
+    # rows, so only one block is ever held in memory. 'nan' is read as a real
+    # NaN. columns, positions in the header, limits values to those columns
+    # in that order. reader names one of READERS
+    return READERS[reader](data, chunk_size, columns)
+
+
+def load_score_matrix(data, columns=None, reader="python"):
+    # Parse the matrix, or only the given columns (positions in the header).
+    # The pandas and pyarrow readers read the whole file in one call
+    samples = read_score_samples(data)
+    if columns is not None:
+        samples = [samples[column] for column in columns]
+    peptides = []
+    chunks = []
+
+    # Parse every row exactly once
+    chunk_size = CHUNK_SIZE if reader == "python" else None
+    for chunk_peptides, chunk_values in iter_score_chunks(
+            data, chunk_size, columns, reader):
+        peptides.extend(chunk_peptides)
+        chunks.append(chunk_values)
+
+    if len(chunks) == 1:
+        values = chunks[0]
+    elif chunks:
+        values = np.vstack(chunks)
+    else:
+        values = np.empty((0, len(samples)), dtype=np.float64)
+
+    return ScoreMatrix(peptides, samples, values)
+
+
+def score_matrix_from_biom(table, dense=True):
+    # Build a ScoreMatrix from a biom.Table (observations are peptides),
+    # such as one viewed from a FeatureTable[Zscore] or FeatureTable[Normed]
+    # artifact, without a round trip through TSV text. With dense=False the
+    # values stay a scipy sparse matrix
+    values = table.matrix_data
+    if dense:
+        values = values.toarray().astype(np.float64, copy=False)
+    else:
+        values = values.tocsc().astype(np.float64)
+
+    return ScoreMatrix(
+        list(table.ids(axis="observation")),
+        list(table.ids(axis="sample")),
+        values
+    )
+
+
+def iter_sparse_chunks(score_matrix, chunk_size=CHUNK_SIZE):
+    # Yield (peptides, values) dense blocks of at most chunk_size rows from a
+    # ScoreMatrix holding a scipy sparse matrix
+    values = score_matrix.values.tocsr()
+    for start in range(0, values.shape[0], chunk_size):
+        yield (
+            score_matrix.peptides[start:start + chunk_size],
+            values[start:start + chunk_size].toarray()
+        )
+
+
+def column_fingerprints(values, columns, salt=""):
+    # Hash of each of the given columns, dense or CSC sparse, prefixed with
+    # salt, used to tell whether a column changed between runs
+    fingerprints = []
+    for column in columns:
+        fingerprint = hashlib.blake2b(salt.encode("utf-8"), digest_size=16)
+        if hasattr(values, "indptr"):
+            column_slice = slice(values.indptr[column], values.indptr[column + 1])
+            fingerprint.update(values.indices[column_slice].tobytes())
+            fingerprint.update(values.data[column_slice].tobytes())
+        else:
+            fingerprint.update(np.ascontiguousarray(values[:, column]).tobytes())
+        fingerprints.append(fingerprint.hexdigest())
+    return fingerprints
+
+
+def _cache_key(data, columns=None):
+    # Identify a matrix file by its location, modification time and size,
+    # and the columns parsed from it
+    stat = os.stat(data)
+    key = "%s\t%d\t%d" % (os.path.realpath(data), stat.st_mtime_ns, stat.st_size)
+    if columns is not None:
+        key += "\t" + ",".join(str(column) for column in columns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _cache_entries(cache_dir):
+    # (last used time, size, key) of every complete entry in cache_dir
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        key, extension = os.path.splitext(file_name)
+        if extension != ".npy":
+            continue
+        values_path = os.path.join(cache_dir, file_name)
+        names_path = os.path.join(cache_dir, key + ".json")
+        try:
+            values_stat = os.stat(values_path)
+            names_stat = os.stat(names_path)
+        except FileNotFoundError:
+            continue
+        entries.append((
+            values_stat.st_mtime,
+            values_stat.st_size + names_stat.st_size,
+            key
+        ))
+    return entries
+
+
+def _evict_cache(cache_dir, cache_max_mb, keep):
+    # Remove least recently used entries until the cache fits in cache_max_mb
+    entries = sorted(_cache_entries(cache_dir))
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+        if cache_size <= cache_max_mb * 1024 * 1024:
+            break
+        if key == keep:
+            continue
+        for extension in (".npy", ".json"):
+            try:
+                os.remove(os.path.join(cache_dir, key + extension))
+            except FileNotFoundError:
+                pass
+        cache_size -= size
+
+
+def load_cached_score_matrix(data, cache_dir, cache_max_mb=CACHE_MAX_MB,
+                             columns=None, reader="python"):
+    # load_score_matrix backed by an on-disk cache of parsed matrices. Values
+    # are stored as .npy and opened memory-mapped (copy-on-write), so a
+    # repeat run on an unchanged file skips text parsing entirely
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _cache_key(data, columns)
+    values_path = os.path.join(cache_dir, key + ".npy")
+    names_path = os.path.join(cache_dir, key + ".json")
+
+    try:
+        with open(names_path, "r") as names_fh:
+            names = json.load(names_fh)
+        values = np.load(values_path, mmap_mode="c")
+    except (FileNotFoundError, ValueError):
+        score_matrix = load_score_matrix(data, columns, reader)
+
+        # Write to temporary files and rename them into place so concurrent
+        # runs never see a partial entry
+        with tempfile.NamedTemporaryFile(
+                dir=cache_dir, suffix=".npy.tmp", delete=False) as values_fh:
+            np.save(values_fh, score_matrix.values)
+        os.replace(values_fh.name, values_path)
+        with tempfile.NamedTemporaryFile(
+                "w", dir=cache_dir, suffix=".json.tmp", delete=False) as names_fh:
+            json.dump(
+                {
+                    "peptides": score_matrix.peptides,
+                    "samples": score_matrix.samples
+                },
+                names_fh
+            )
+        os.replace(names_fh.name, names_path)
+    else:
+        score_matrix = ScoreMatrix(names["peptides"], names["samples"], values)
+
+        # Mark the entry as recently used
+        os.utime(values_path)
+
+    _evict_cache(cache_dir, cache_max_mb, keep=key)
+    return score_matrix
@@ -37,3 +37,33 @@
 #     df.to_csv(str(result), sep='\t')
 
 #     return result
+
+
+from q2_ps_qc.plugin_setup import plugin
+from q2_ps_qc.format_types import (
+    PairCorrelationsFormat, PAIR_CORRELATIONS_COLUMNS
+)
+
+import pandas as pd
+
+
+@plugin.register_transformer
+def _2(data: pd.DataFrame) -> PairCorrelationsFormat:
+    result = PairCorrelationsFormat()
+    data.to_csv(
+        str(result), sep="\t", index=False, na_rep="nan",
+        columns=PAIR_CORRELATIONS_COLUMNS
+    )
+    return result
+
+
+@plugin.register_transformer
+def _3(ff: PairCorrelationsFormat) -> pd.DataFrame:
+    return pd.read_csv(
+        str(ff), sep="\t",
+        dtype={
+            "sample_a": str, "sample_b": str, "group": str, "status": str,
+            "fingerprint_a": str, "fingerprint_b": str
+        },
+        keep_default_na=False, na_values={"r": ["nan", "NaN"]}
+    )